@@ -1,10 +1,26 @@
 #!/usr/bin/env python3
+from __future__ import annotations
+
 import argparse
+import hashlib
+import json
+import os
+import re
+import shutil
 import sys
+import tempfile
+from contextlib import contextmanager
+from functools import lru_cache
+from itertools import repeat
 from pathlib import Path
-from typing import List, Tuple, Optional
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from typing import Callable, Iterable, Iterator, List, Tuple, Optional
+
+    from pypdf import PdfReader, PdfWriter
 
-from pypdf import PdfReader, PdfWriter
+# pypdf is imported inside the commands so --help and argument errors stay fast.
 
 
 def err(msg: str, code: int = 2) -> None:
@@ -17,41 +33,37 @@ def require_exists(path: Path) -> None:
         err(f"Input not found: {path}")
 
 
+# One token per match: "A-B" | "-B" | "A-" | "N", or empty (e.g. "1,,2" / trailing comma).
+# Signs are accepted where int() accepted them, so "+3" still parses and "1--2"
+# still reports a non-positive range rather than an invalid token.
+_RANGE_RE = re.compile(
+    r"\s*(?:(\+?\d+)\s*-\s*([+-]?\d+)|-\s*([+-]?\d+)|(\+?\d+)\s*-|(\+?\d+))?\s*(?:,|$)",
+    re.ASCII,
+)
+
+
 def parse_ranges(spec: str, total_pages: int) -> List[Tuple[int, int]]:
-    tokens = [t.strip() for t in spec.split(",") if t.strip()]
-    if not tokens:
-        err("No pages matched ranges: (empty spec)")
     result: List[Tuple[int, int]] = []
-    for tok in tokens:
-        if tok == "-":
-            err("Invalid range token: '-'")
-        if "-" in tok:
-            if tok.startswith("-"):
-                # -B  => 1..B
-                try:
-                    end = int(tok[1:])
-                except ValueError:
-                    err(f"Invalid range token: '{tok}'")
-                start = 1
-            elif tok.endswith("-"):
-                # A-  => A..end
-                try:
-                    start = int(tok[:-1])
-                except ValueError:
-                    err(f"Invalid range token: '{tok}'")
-                end = total_pages
-            else:
-                a, b = tok.split("-", 1)
-                try:
-                    start, end = int(a), int(b)
-                except ValueError:
-                    err(f"Invalid range token: '{tok}'")
+    pos = 0
+    for m in _RANGE_RE.finditer(spec):
+        if m.start() != pos:
+            break  # unmatched text before this token
+        pos = m.end()
+        a, b, to_end, from_start, single = m.groups()
+        if a is not None:
+            start, end = int(a), int(b)
+        elif to_end is not None:
+            # -B  => 1..B
+            start, end = 1, int(to_end)
+        elif from_start is not None:
+            # A-  => A..end
+            start, end = int(from_start), total_pages
+        elif single is not None:
+            start = end = int(single)
         else:
-            try:
-                start = end = int(tok)
-            except ValueError:
-                err(f"Invalid range token: '{tok}'")
+            continue  # empty token
 
+        tok = m.group(0).rstrip(",").strip()
         if start <= 0 or end <= 0:
             err(f"Range must be positive: '{tok}'")
         if start > end:
@@ -60,133 +72,315 @@ def parse_ranges(spec: str, total_pages: int) -> List[Tuple[int, int]]:
             err(f"Range out of bounds for file with {total_pages} pages: {tok}")
         result.append((start, end))
 
+    if pos != len(spec):
+        tok = spec[pos:].split(",", 1)[0].strip()
+        err(f"Invalid range token: '{tok}'")
     if not result:
-        err(f"No pages matched ranges: {spec}")
+        err("No pages matched ranges: (empty spec)")
     return result
 
 
+_WRITE_BUFFER = 4 * 1024 * 1024
+
+
+@contextmanager
+def _atomic_target(target: Path) -> Iterator[Path]:
+    # Yields a temp path next to target; it replaces target only if the body succeeds,
+    # so an interrupted write never leaves a truncated PDF behind.
+    # Symlinks are resolved first so the link's destination is what gets replaced.
+    target = Path(os.path.realpath(target))
+    fd, tmp = tempfile.mkstemp(dir=target.parent, prefix=".pdfmerge.", suffix=".part")
+    os.close(fd)
+    tmp_path = Path(tmp)
+    try:
+        yield tmp_path
+        # Data must be on disk before the rename makes it visible as target.
+        with open(tmp_path, "rb+") as f:
+            os.fsync(f.fileno())
+            if hasattr(os, "posix_fadvise"):
+                # Output is rarely re-read right away; don't let it evict hot page cache.
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        if target.exists():
+            shutil.copymode(target, tmp_path)  # keep an existing output's mode
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp_path, 0o666 & ~umask)  # mkstemp creates 0600
+        os.replace(tmp_path, target)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+
+def _atomic_write(target: Path, writer: PdfWriter) -> None:
+    with _atomic_target(target) as tmp:
+        # Large buffer: pypdf serializes with many small write() calls.
+        with open(tmp, "wb", buffering=_WRITE_BUFFER) as f:
+            writer.write(f)
+
+
+class _DecryptError(Exception):
+    pass
+
+
+@lru_cache(maxsize=32)
+def _cached_reader(realpath: str, mtime_ns: int, size: int, password: Optional[str]) -> PdfReader:
+    # mtime_ns/size are only part of the cache key: a modified file gets a fresh reader.
+    from pypdf import PdfReader
+
+    fh = open(realpath, "rb")
+    try:
+        reader = PdfReader(fh)
+        if reader.is_encrypted and password and not reader.decrypt(password):
+            raise _DecryptError(realpath)
+    except BaseException:
+        fh.close()
+        raise
+    reader._fh = fh  # keep the handle alive as long as the reader is cached
+    return reader
+
+
 def open_reader(path: Path, password: Optional[str]) -> PdfReader:
     require_exists(path)
-    fh = path.open("rb")
+    st = os.stat(path)
     try:
+        reader = _cached_reader(str(path.resolve()), st.st_mtime_ns, st.st_size, password)
+    except _DecryptError:
+        err(f"Failed to decrypt: {path} (check --password)")
+    if reader.is_encrypted and not password:
+        err(f"File is encrypted: {path} (pass --password)")
+    return reader
+
+
+@contextmanager
+def read_pdf(path: Path, password: Optional[str]) -> Iterator[PdfReader]:
+    # Uncached: a fresh reader per call, and its file is closed when the block exits.
+    from pypdf import PdfReader
+
+    require_exists(path)
+    with open(path, "rb") as fh:
         reader = PdfReader(fh)
         if reader.is_encrypted:
             if not password:
-                fh.close()
                 err(f"File is encrypted: {path} (pass --password)")
-            ok = reader.decrypt(password)
-            if not ok:  # decrypt returns 0/1
-                fh.close()
+            if not reader.decrypt(password):
                 err(f"Failed to decrypt: {path} (check --password)")
-        return reader
-    except Exception:
-        fh.close()
-        raise
+        yield reader
+
 
+def normalized_metadata(reader: PdfReader) -> dict[str, str]:
+    src_md = reader.metadata or {}
+    return {k: "" if v is None else str(v)
+            for k, v in src_md.items() if isinstance(k, str) and k.startswith("/")}
+
+
+def merge_cmd(inputs: list[str], output: str, password: str | None, overwrite: bool,
+              lite: bool = False, drop_annots: bool = False, drop_outlines: bool = False,
+              drop_xmp: bool = False) -> None:
+    from pypdf import PdfWriter
 
-def merge_cmd(inputs: list[str], output: str, password: str | None, overwrite: bool) -> None:
-    from pathlib import Path
-    import sys
     out_path = Path(output)
     if out_path.exists() and not overwrite:
         print(f"Refusing to overwrite existing file: {out_path} (use --overwrite)", file=sys.stderr)
         sys.exit(2)
 
-    readers = []
-    fhs = []
-    try:
-        for path in inputs:
-            fh = open(path, "rb")
-            fhs.append(fh)
-            r = PdfReader(fh)
-            if r.is_encrypted:
-                if not password:
-                    print(f"File is encrypted: {path} (pass --password)", file=sys.stderr)
-                    sys.exit(2)
-                if not r.decrypt(password):
-                    print(f"Failed to decrypt: {path} (check --password)", file=sys.stderr)
-                    sys.exit(2)
-            readers.append(r)
-
-        writer = PdfWriter()
-        # preserve metadata from first input
-        if readers and readers[0].metadata:
-            md = {}
-            for k, v in readers[0].metadata.items():
-                if k and str(k).startswith("/"):
-                    md[str(k)] = "" if v is None else str(v)
-            if md:
-                writer.add_metadata(md)
-
-        for r in readers:
-            for page in r.pages:
-                writer.add_page(page)
-
+    if lite:
+        drop_annots = drop_outlines = drop_xmp = True
+    rewrite = lite or drop_annots or drop_outlines or drop_xmp
+
+    if len(inputs) == 1 and not password and not rewrite:
+        # Nothing to merge: a plain copy (sendfile on Linux) gives the same bytes.
+        src = Path(inputs[0])
+        require_exists(src)
+        with src.open("rb") as fh:
+            if fh.read(5) != b"%PDF-":
+                err(f"Not a PDF file: {src}")
+        with read_pdf(src, None):
+            pass  # parses the trailer only; rejects encrypted input like the full path
         out_path.parent.mkdir(parents=True, exist_ok=True)
-        with out_path.open("wb") as f:
-            writer.write(f)
-    finally:
-        for fh in fhs:
-            try: fh.close()
-            except: pass
-
-
-def make_split_name(base: str, start: int, end: int, pattern: Optional[str]) -> str:
-    if pattern:
+        with _atomic_target(out_path) as tmp:
+            shutil.copyfile(src, tmp)
+        return
+
+    writer = PdfWriter()
+
+    # append() reuses indirect references instead of cloning page by page.
+    # Excluded keys are never cloned, so whatever they reference (e.g. images
+    # behind annotation appearances) is not imported either.
+    excluded = []
+    if drop_annots:
+        excluded += ["/Annots", "/StructParents"]
+    if drop_xmp:
+        excluded.append("/Metadata")  # per-page/XObject XMP streams
+    if lite:
+        excluded.append("/B")  # article threads
+
+    # One input open at a time: append() copies what it needs, so each file is
+    # closed before the next is opened and large merges can't run out of fds.
+    # Readers are not served from the cache: pypdf keys its clone map on the
+    # reader object, so a repeated input needs its own reader or its outline
+    # and links would point at the first copy's pages.
+    for i, path in enumerate(inputs):
+        with read_pdf(Path(path), password) as r:
+            if i == 0:
+                # preserve metadata from first input
+                md = normalized_metadata(r)
+                if md:
+                    writer.add_metadata(md)
+            writer.append(r, import_outline=not drop_outlines, excluded_fields=excluded)
+    if drop_xmp:
+        writer.xmp_metadata = None
+
+    # Share identical objects repeated across inputs (e.g. the same embedded font).
+    # Not worth it for split: one reader's objects are already shared by pypdf's clone.
+    writer.compress_identical_objects(remove_identicals=True, remove_orphans=True)
+
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    _atomic_write(out_path, writer)
+
+
+def make_split_name(base: str, start: int, end: int, fmt: Optional[Callable[..., str]]) -> str:
+    # fmt is the user's --name-pattern bound once per split (pattern.format)
+    page = start if start == end else None
+    if fmt:
         # Users may supply either page or start/end; both are available.
-        return pattern.format(base=base, page=start if start == end else None, start=start, end=end)
-    if start == end:
-        return f"{base}_p{start}.pdf"
+        return fmt(base=base, page=page, start=start, end=end)
+    if page is not None:
+        return f"{base}_p{page}.pdf"
     return f"{base}_p{start}-{end}.pdf"
 
 
+def _write_range(in_path: str, password: Optional[str], a: int, b: int, target: str) -> None:
+    # Runs in a worker process: each worker opens (and caches) its own reader/fd.
+    from pypdf import PdfWriter
+
+    reader = open_reader(Path(in_path), password)
+    total = len(reader.pages)
+    if b > total:
+        # Only reachable through a stale page-count cache entry; slicing would
+        # silently write a short (or empty) file.
+        err(f"Range out of bounds for file with {total} pages: {a}-{b}")
+    writer = PdfWriter()
+    add_page = writer.add_page
+    for page in reader.pages[a - 1:b]:  # convert to 0-based
+        add_page(page)
+    _atomic_write(Path(target), writer)
+
+
+_FINGERPRINT_TAIL = 1024  # file tail hashed into the key (holds startxref/trailer)
+
+
+def _page_count_cache_file(path: Path) -> Path:
+    st = path.stat()
+    h = hashlib.blake2b(
+        f"{path.resolve()}:{st.st_mtime_ns}:{st.st_size}".encode(), digest_size=16
+    )
+    # A rewrite that keeps size and mtime almost never keeps the xref offset too.
+    with open(path, "rb") as fh:
+        fh.seek(max(0, st.st_size - _FINGERPRINT_TAIL))
+        h.update(fh.read())
+    key = h.hexdigest()
+    root = Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache")
+    return root / "pdf-split-merge" / f"{key}.json"
+
+
+def cached_page_count(path: Path) -> Optional[int]:
+    # Keyed on mtime/size and the file tail, so a modified file simply misses the cache.
+    try:
+        return int(json.loads(_page_count_cache_file(path).read_text())["pages"])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def store_page_count(path: Path, total: int) -> None:
+    try:
+        cache_file = _page_count_cache_file(path)
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        cache_file.write_text(json.dumps({"pages": total}))
+    except OSError:
+        pass  # caching is best-effort
+
+
+def _planned_clashes(planned: Iterable[Path]) -> List[Path]:
+    # One directory listing per target directory instead of a stat() per output.
+    # --name-pattern may contain subdirectories or absolute paths, so group by parent.
+    planned = list(planned)
+    existing: dict[Path, set[str]] = {}
+    for parent in {p.parent for p in planned}:
+        try:
+            with os.scandir(parent) as it:
+                existing[parent] = {e.name for e in it}
+        except (FileNotFoundError, NotADirectoryError):
+            existing[parent] = set()
+    return [p for p in planned if p.name in existing[p.parent]]
+
+
+def coalesce_ranges(ranges: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    # Sort, then fold overlapping or adjacent ranges: 1-3,2-5,6 => 1-6
+    merged: List[Tuple[int, int]] = []
+    for a, b in sorted(ranges):
+        if merged and a <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], b))
+        else:
+            merged.append((a, b))
+    return merged
+
+
 def split_cmd(input_file: str, ranges_spec: str, outdir: str, password: Optional[str],
-            name_pattern: Optional[str], overwrite: bool) -> None:
+            name_pattern: Optional[str], overwrite: bool, coalesce: bool = False) -> None:
     in_path = Path(input_file)
     require_exists(in_path)
     out_dir = Path(outdir) if outdir else Path(".")
     out_dir.mkdir(parents=True, exist_ok=True)
 
-    # Open/decrypt
-    fh = in_path.open("rb")
-    try:
-        reader = PdfReader(fh)
-        if reader.is_encrypted:
-            if not password:
-                err(f"File is encrypted: {in_path} (pass --password)")
-            ok = reader.decrypt(password)
-            if not ok:
-                err(f"Failed to decrypt: {in_path} (check --password)")
-
+    # Page count only; the workers open the PDF themselves. Encrypted files are
+    # never cached so a missing/wrong password is still reported up front.
+    total = cached_page_count(in_path)
+    if total is None:
+        reader = open_reader(in_path, password)
         total = len(reader.pages)
-        ranges = parse_ranges(ranges_spec, total)
-        base = in_path.stem
-
-        # Plan filenames
-        planned = []
-        for (a, b) in ranges:
-            name = make_split_name(base, a, b, name_pattern)
-            planned.append(out_dir / name)
-
-        # Overwrite guard
-        clashes = [p for p in planned if p.exists()]
-        if clashes and not overwrite:
-            msg = "Refusing to overwrite existing files:\n" + "\n".join(str(p) for p in clashes) + "\n(use --overwrite)"
-            err(msg)
-
-        # Write outputs
+        if not reader.is_encrypted:
+            store_page_count(in_path, total)
+    ranges = parse_ranges(ranges_spec, total)
+    if coalesce:
+        ranges = coalesce_ranges(ranges)
+    base = in_path.stem
+
+    # Plan filenames
+    fmt = name_pattern.format if name_pattern else None
+    planned = [out_dir / make_split_name(base, a, b, fmt) for a, b in ranges]
+
+    # Overwrite guard
+    clashes = _planned_clashes(planned)
+    if clashes and not overwrite:
+        msg = "Refusing to overwrite existing files:\n" + "\n".join(str(p) for p in clashes) + "\n(use --overwrite)"
+        err(msg)
+
+    # Write outputs in worker processes (serialization is CPU-bound). Workers live
+    # for the whole pool, so each parses the input once via its own reader cache.
+    workers = min(len(ranges), os.cpu_count() or 1)
+    if workers <= 1:
         for (a, b), target in zip(ranges, planned):
-            writer = PdfWriter()
-            for i in range(a - 1, b):  # convert to 0-based
-                writer.add_page(reader.pages[i])
-            with target.open("wb") as out_f:
-                writer.write(out_f)
-
-    finally:
-        try:
-            fh.close()
-        except Exception:
-            pass
+            _write_range(str(in_path), password, a, b, str(target))
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+
+        starts, ends = zip(*ranges)
+        # Batching only cuts per-task IPC; it has no effect on reader reuse.
+        chunksize = max(1, len(ranges) // (workers * 4))
+        # Forked workers would inherit the parent's cached reader and share its
+        # file offset; clear the cache so each worker opens its own handle.
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=_cached_reader.cache_clear)
+        with pool as executor:
+            list(executor.map(
+                _write_range,
+                repeat(str(in_path)),
+                repeat(password),
+                starts,
+                ends,
+                map(str, planned),
+                chunksize=chunksize,
+            ))
 
 
 def build_parser() -> argparse.ArgumentParser:
@@ -199,6 +393,11 @@ def build_parser() -> argparse.ArgumentParser:
     m.add_argument("-o", "--output", required=True, help="Output PDF file")
     m.add_argument("--password", help="Password for encrypted inputs (applied to all)")
     m.add_argument("--overwrite", action="store_true", help="Allow overwriting existing output")
+    m.add_argument("--lite-merge", action="store_true",
+                   help="Concatenate pages only (implies all --drop-* flags, also skips threads)")
+    m.add_argument("--drop-annots", action="store_true", help="Do not import annotations")
+    m.add_argument("--drop-outlines", action="store_true", help="Do not import outlines (bookmarks)")
+    m.add_argument("--drop-xmp", action="store_true", help="Do not import XMP metadata streams")
 
     # split
     s = sub.add_parser("split", help="Split a PDF by page ranges")
@@ -208,6 +407,8 @@ def build_parser() -> argparse.ArgumentParser:
     s.add_argument("--name-pattern", help="Filename pattern using {base}, {page}, {start}, {end}")
     s.add_argument("--password", help="Password if input is encrypted")
     s.add_argument("--overwrite", action="store_true", help="Allow overwriting existing files")
+    s.add_argument("--coalesce", action="store_true",
+                   help="Merge overlapping/adjacent ranges into a single output")
 
     return p
 
@@ -216,7 +417,16 @@ def main(argv: Optional[List[str]] = None) -> None:
     args = parser.parse_args(argv)
 
     if args.cmd == "merge":
-        merge_cmd(inputs=args.inputs, output=args.output, password=args.password, overwrite=args.overwrite)
+        merge_cmd(
+            inputs=args.inputs,
+            output=args.output,
+            password=args.password,
+            overwrite=args.overwrite,
+            lite=args.lite_merge,
+            drop_annots=args.drop_annots,
+            drop_outlines=args.drop_outlines,
+            drop_xmp=args.drop_xmp,
+        )
     elif args.cmd == "split":
         split_cmd(
             input_file=args.input,
@@ -225,6 +435,7 @@ def main(argv: Optional[List[str]] = None) -> None:
             password=args.password,
             name_pattern=args.name_pattern,
             overwrite=args.overwrite,
+            coalesce=args.coalesce,
         )
     else:
         parser.print_help()